@@ -13,143 +13,249 @@
 
 import os
 import io
-import math
+import importlib.util
+import copy
+import hashlib
 import json
+import re
 import sqlite3
+import threading
+from string import Template
 from datetime import datetime
-from typing import Dict, Any, Tuple
+from itertools import islice
+from typing import Dict, Any, Tuple, Iterable
 
 import numpy as np
 import pandas as pd
-from PIL import Image
+import pyarrow as pa
+from PIL import Image, ImageOps
 
 import streamlit as st
 
 # 姿勢チェックは MediaPipe があれば有効化
-POSE_AVAILABLE = True
+# import 自体は重い（TFLite等の読込）ため、初回の姿勢解析まで遅延する（_try_import_pose）
+POSE_AVAILABLE = importlib.util.find_spec("mediapipe") is not None
+
+# 姿勢結果のJSON保存：orjson があれば利用（無ければ標準 json）
 try:
-    import mediapipe as mp
+    import orjson
 except Exception:
-    POSE_AVAILABLE = False
+    orjson = None
+
+# エクスポート高速化：polars があればCSV書き出しに利用（無ければpandas）
+try:
+    import polars as pl
+except Exception:
+    pl = None
 
 # Wordレポート作成（日本語OK）
 from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+from xml.sax.saxutils import escape
 
 APP_TITLE = "AIフィットネス診断 & 姿勢チェック（個人トレーナー向け）"
 DB_PATH = "data.db"
+# 保存データ一覧の1ページあたり行数
+PAGE_SIZE = 1000
+# 姿勢解析前に縮小する長辺の上限（BlazePose は内部で256px程度に縮小するため十分）
+POSE_MAX_SIDE = 640
+# アップロード画像プレビューの長辺上限とJPEG品質
+PREVIEW_MAX_SIDE = 800
+PREVIEW_JPEG_QUALITY = 70
+
+# INSERT文はモジュール定数にしておき、sqlite3側の文キャッシュに乗せて使い回す
+LEAD_SQL = """
+INSERT INTO leads (name, email, phone, age, gender, height_cm, weight_kg, activity_level, goal, dietary_prefs, allergies, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+ASSESS_SQL = """
+INSERT INTO assessments (lead_id, bmi, bmr, tdee, target_calories, protein_g, fat_g, carbs_g, notes, posture_findings, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
 
 # ============== DB ユーティリティ ==============
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS leads (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        email TEXT,
-        phone TEXT,
-        age INTEGER,
-        gender TEXT,
-        height_cm REAL,
-        weight_kg REAL,
-        activity_level TEXT,
-        goal TEXT,
-        dietary_prefs TEXT,
-        allergies TEXT,
-        created_at TEXT
-    )
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS assessments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        lead_id INTEGER,
-        bmi REAL,
-        bmr REAL,
-        tdee REAL,
-        target_calories REAL,
-        protein_g REAL,
-        fat_g REAL,
-        carbs_g REAL,
-        notes TEXT,
-        posture_findings TEXT,
-        created_at TEXT,
-        FOREIGN KEY (lead_id) REFERENCES leads(id)
-    )
+@st.cache_resource
+def get_conn() -> sqlite3.Connection:
+    # プロセス内で1本の接続を使い回す（WAL：書き込み中も読み出し可能）
+    # isolation_level="IMMEDIATE"：トランザクション開始時に BEGIN IMMEDIATE で書き込みロックを確保
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level="IMMEDIATE")
+    conn.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
     """)
-    conn.commit()
-    conn.close()
+    return conn
 
 
-def insert_lead_and_assessment(lead: Dict[str, Any], assess: Dict[str, Any]) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-    INSERT INTO leads (name, email, phone, age, gender, height_cm, weight_kg, activity_level, goal, dietary_prefs, allergies, created_at)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+@st.cache_resource
+def _db_lock() -> threading.Lock:
+    # 接続は全セッションで共有するため、トランザクションと読み出しを直列化する
+    return threading.Lock()
+
+
+@st.cache_resource
+def init_db():
+    # スキーマ作成はプロセスごとに1度だけ
+    conn = get_conn()
+    with _db_lock():
+        c = conn.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS leads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            email TEXT,
+            phone TEXT,
+            age INTEGER,
+            gender TEXT,
+            height_cm REAL,
+            weight_kg REAL,
+            activity_level TEXT,
+            goal TEXT,
+            dietary_prefs TEXT,
+            allergies TEXT,
+            created_at TEXT
+        )
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS assessments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER,
+            bmi REAL,
+            bmr REAL,
+            tdee REAL,
+            target_calories REAL,
+            protein_g REAL,
+            fat_g REAL,
+            carbs_g REAL,
+            notes TEXT,
+            posture_findings TEXT,
+            created_at TEXT,
+            FOREIGN KEY (lead_id) REFERENCES leads(id)
+        )
+        """)
+        # 一覧の ORDER BY created_at DESC をソート無しで返すためのインデックス
+        c.execute("CREATE INDEX IF NOT EXISTS idx_leads_created ON leads(created_at DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_assessments_created ON assessments(created_at DESC)")
+        conn.commit()
+
+
+@st.cache_resource
+def _analyze_once() -> bool:
+    # 最初の書き込み後に1度だけ統計情報を更新し、プランナーにインデックスを使わせる
+    conn = get_conn()
+    with _db_lock(), conn:
+        conn.execute("ANALYZE")
+    return True
+
+
+def dumps_json(obj: Any) -> str:
+    # どちらも非ASCII文字をそのまま UTF-8 で出力する
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _lead_params(lead: Dict[str, Any]) -> Tuple:
+    return (
         lead["name"], lead["email"], lead["phone"], lead["age"], lead["gender"],
         lead["height_cm"], lead["weight_kg"], lead["activity_level"], lead["goal"],
         lead["dietary_prefs"], lead["allergies"], lead["created_at"]
-    ))
-    lead_id = c.lastrowid
-    c.execute("""
-    INSERT INTO assessments (lead_id, bmi, bmr, tdee, target_calories, protein_g, fat_g, carbs_g, notes, posture_findings, created_at)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        lead_id, assess["bmi"], assess["bmr"], assess["tdee"], assess["target_calories"],
-        assess["protein_g"], assess["fat_g"], assess["carbs_g"], assess["notes"],
-        assess.get("posture_findings", ""), assess["created_at"]
-    ))
-    conn.commit()
-    conn.close()
+    )
+
+
+def insert_lead_and_assessment(lead: Dict[str, Any], assess: Dict[str, Any]) -> int:
+    conn = get_conn()
+    with _db_lock(), conn:
+        c = conn.cursor()
+        c.execute(LEAD_SQL, _lead_params(lead))
+        lead_id = c.lastrowid
+        c.execute(ASSESS_SQL, (
+            lead_id, assess["bmi"], assess["bmr"], assess["tdee"], assess["target_calories"],
+            assess["protein_g"], assess["fat_g"], assess["carbs_g"], assess["notes"],
+            assess.get("posture_findings", ""), assess["created_at"]
+        ))
+    _analyze_once()
+    _bump_db_version()
     return lead_id
 
 
+def insert_leads_many(leads: Iterable[Dict[str, Any]]) -> int:
+    # CSV一括取り込み用：1トランザクションでまとめてINSERT
+    rows = [_lead_params(lead) for lead in leads]
+    conn = get_conn()
+    with _db_lock(), conn:
+        conn.executemany(LEAD_SQL, rows)
+    _analyze_once()
+    _bump_db_version()
+    return len(rows)
+
+
+@st.cache_resource
+def _db_version() -> Dict[str, Any]:
+    # 全セッション共通の書き込み世代（cache_data は全セッションで共有されるため）
+    return {"value": 0, "lock": threading.Lock()}
+
+
+def _bump_db_version():
+    # 書き込み後に load_all_data のキャッシュを無効化する
+    version = _db_version()
+    with version["lock"]:
+        version["value"] += 1
+
+
+@st.cache_data(ttl=60)
+def _load_all_data(version: int):
+    # version はキャッシュキー専用
+    conn = get_conn()
+    with _db_lock():
+        leads = pd.read_sql_query("SELECT * FROM leads ORDER BY created_at DESC", conn)
+        assessments = pd.read_sql_query("SELECT * FROM assessments ORDER BY created_at DESC", conn)
+    # 一覧表示用の Arrow テーブルも読込時に1度だけ作り、描画時はスライスのみ行う
+    leads_table = pa.Table.from_pandas(leads, preserve_index=False)
+    assessments_table = pa.Table.from_pandas(assessments, preserve_index=False)
+    return leads, assessments, leads_table, assessments_table
+
+
 def load_all_data():
-    conn = sqlite3.connect(DB_PATH)
-    leads = pd.read_sql_query("SELECT * FROM leads ORDER BY created_at DESC", conn)
-    assessments = pd.read_sql_query("SELECT * FROM assessments ORDER BY created_at DESC", conn)
-    conn.close()
-    return leads, assessments
+    return _load_all_data(_db_version()["value"])
 
 
 # ============== 栄養計算ユーティリティ ==============
+# 選択肢と係数は添字で対応させ、フォーム送信時に1度だけ添字へ変換する
+GENDERS = ("男性", "女性")
+BMR_GENDER_OFFSETS = (5.0, -161.0)
+ACTIVITY_LEVELS = (
+    "低い（デスクワーク中心/運動ほぼ無し）",
+    "やや低い（週1〜2軽い運動）",
+    "普通（週3〜4運動）",
+    "高い（週5以上ハード）",
+    "非常に高い（アスリート級）",
+)
+ACTIVITY_FACTORS = (1.2, 1.375, 1.55, 1.725, 1.9)
+GOALS = ("減量（-15〜20%）", "緩やか減量（-10%）", "現状維持", "増量（+10%）")
+GOAL_FACTORS = (0.85, 0.90, 1.0, 1.10)
+
+
 def calc_bmi(weight_kg: float, height_cm: float) -> float:
     h_m = height_cm / 100.0
     return round(weight_kg / (h_m ** 2), 2)
 
 
-def mifflin_st_jeor_bmr(gender: str, weight_kg: float, height_cm: float, age: int) -> float:
-    # 男性: 10W + 6.25H - 5A + 5, 女性: 10W + 6.25H - 5A - 161
-    if gender == "男性":
-        return 10 * weight_kg + 6.25 * height_cm - 5 * age + 5
-    else:
-        return 10 * weight_kg + 6.25 * height_cm - 5 * age - 161
+def mifflin_st_jeor_bmr(gender_i: int, weight_kg: float, height_cm: float, age: int) -> float:
+    # 男性: 10W + 6.25H - 5A + 5, 女性: 10W + 6.25H - 5A - 161（gender_i は GENDERS の添字）
+    return 10 * weight_kg + 6.25 * height_cm - 5 * age + BMR_GENDER_OFFSETS[gender_i]
 
 
-def activity_factor(level: str) -> float:
-    mapping = {
-        "低い（デスクワーク中心/運動ほぼ無し）": 1.2,
-        "やや低い（週1〜2軽い運動）": 1.375,
-        "普通（週3〜4運動）": 1.55,
-        "高い（週5以上ハード）": 1.725,
-        "非常に高い（アスリート級）": 1.9,
-    }
-    return mapping.get(level, 1.2)
-
-
-def target_calories_from_goal(tdee: float, goal: str) -> float:
-    if goal == "減量（-15〜20%）":
-        return round(tdee * 0.85)
-    elif goal == "緩やか減量（-10%）":
-        return round(tdee * 0.90)
-    elif goal == "現状維持":
-        return round(tdee)
-    elif goal == "増量（+10%）":
-        return round(tdee * 1.10)
-    else:
-        return round(tdee)
+def activity_factor(act_i: int) -> float:
+    # act_i は ACTIVITY_LEVELS の添字
+    return ACTIVITY_FACTORS[act_i]
+
+
+def target_calories_from_goal(tdee: float, goal_i: int) -> float:
+    # goal_i は GOALS の添字
+    return round(tdee * GOAL_FACTORS[goal_i])
 
 
 def macro_plan(weight_kg: float, calories: float, goal: str):
@@ -165,32 +271,54 @@ def macro_plan(weight_kg: float, calories: float, goal: str):
     return round(protein_g), round(fat_g), round(carbs_g)
 
 
+def compute_all(gender_i: int, weight_kg: float, height_cm: float, age: int, act_i: int, goal_i: int):
+    # 添字ベースで BMI〜PFC までを一括計算（一括取り込み時の再計算にも使う）
+    bmi = calc_bmi(weight_kg, height_cm)
+    bmr = mifflin_st_jeor_bmr(gender_i, weight_kg, height_cm, age)
+    tdee = bmr * activity_factor(act_i)
+    target_cal = target_calories_from_goal(tdee, goal_i)
+    p, f, c = macro_plan(weight_kg, target_cal, GOALS[goal_i])
+    return bmi, bmr, tdee, target_cal, p, f, c
+
+
 # ============== 食事提案（1日例） ==============
+BREAKFAST_MENU = (
+    "オートミール+無糖ヨーグルト+ベリー",
+    "全卵1+卵白2のスクランブル+玄米おにぎり",
+    "プロテインシェイク+バナナ",
+)
+LUNCH_MENU = (
+    "鶏むねグリル150g+雑穀米150g+サラダ",
+    "鮭の塩焼き+さつまいも200g+味噌汁",
+    "豆腐ステーキ+玄米150g+野菜炒め",
+)
+DINNER_MENU = (
+    "白身魚のホイル焼き+ブロッコリー+じゃがいも150g",
+    "豚ヒレ100g+白菜スープ+玄米120g",
+    "鶏つくね鍋（春雨少量）",
+)
+SNACK_MENU = (
+    "プロテインバー/和風おにぎり/枝豆/ミックスナッツ少量",
+)
+
+
 def meal_suggestions(cal: int, p: int, f: int, c: int, prefs: str, allergies: str, goal: str):
     avoid = [a.strip() for a in allergies.split(",") if a.strip()]
     lowfat = goal.startswith("減量")
+    # 回避食材は1本の正規表現にまとめ、各メニューを1回だけ走査する
+    pat = re.compile("|".join(re.escape(a) for a in avoid), re.IGNORECASE) if avoid else None
 
     def ok(item: str) -> bool:
-        return all(a.lower() not in item.lower() for a in avoid)
-
-    breakfast = [i for i in [
-        "オートミール+無糖ヨーグルト+ベリー",
-        "全卵1+卵白2のスクランブル+玄米おにぎり",
-        "プロテインシェイク+バナナ",
-    ] if ok(i)]
-    lunch = [i for i in [
-        "鶏むねグリル150g+雑穀米150g+サラダ",
-        "鮭の塩焼き+さつまいも200g+味噌汁",
-        "豆腐ステーキ+玄米150g+野菜炒め",
-    ] if ok(i)]
-    dinner = [i for i in [
-        "白身魚のホイル焼き+ブロッコリー+じゃがいも150g",
-        "豚ヒレ100g+白菜スープ+玄米120g",
-        "鶏つくね鍋（春雨少量）",
-    ] if ok(i)]
-    snack = [i for i in [
-        "プロテインバー/和風おにぎり/枝豆/ミックスナッツ少量",
-    ] if ok(i)]
+        return pat is None or not pat.search(item)
+
+    def pick(menu: Tuple[str, ...], n: int):
+        # 必要な件数が揃った時点で走査を打ち切る
+        return list(islice((i for i in menu if ok(i)), n))
+
+    breakfast = pick(BREAKFAST_MENU, 2)
+    lunch = pick(LUNCH_MENU, 2)
+    dinner = pick(DINNER_MENU, 2)
+    snack = pick(SNACK_MENU, 1)
 
     guide = f"""
 - 1日の目標：{cal} kcal / P{p}g F{f}g C{c}g
@@ -200,15 +328,52 @@ def meal_suggestions(cal: int, p: int, f: int, c: int, prefs: str, allergies: st
 - 好み：{prefs or "（未入力）"} / アレルギー回避：{', '.join(avoid) if avoid else 'なし'}
 """.strip()
     return {
-        "breakfast": breakfast[:2] or ["（該当食材を回避して選択）"],
-        "lunch": lunch[:2] or ["（該当食材を回避して選択）"],
-        "dinner": dinner[:2] or ["（該当食材を回避して選択）"],
-        "snack": snack[:1],
+        "breakfast": breakfast or ["（該当食材を回避して選択）"],
+        "lunch": lunch or ["（該当食材を回避して選択）"],
+        "dinner": dinner or ["（該当食材を回避して選択）"],
+        "snack": snack,
         "guide": guide
     }
 
 
 # ============== 姿勢チェック（MediaPipe） ==============
+@st.cache_resource
+def _try_import_pose():
+    # 失敗時は None をキャッシュし、以降は解析をスキップする
+    try:
+        import mediapipe as mp
+        return mp
+    except Exception:
+        return None
+
+
+@st.cache_resource
+def get_pose():
+    # グラフ初期化は重いので1度だけ。軽量モデル（complexity=0）で静止画モード
+    mp = _try_import_pose()
+    return mp.solutions.pose.Pose(
+        static_image_mode=True,
+        model_complexity=0,
+        enable_segmentation=False,
+        min_detection_confidence=0.4,
+    )
+
+
+@st.cache_resource
+def _pose_lock() -> threading.Lock:
+    # Pose はスレッドセーフではないため、セッション間で process を直列化する
+    return threading.Lock()
+
+
+def make_preview_jpeg(image: Image.Image) -> bytes:
+    # プレビュー用の縮小JPEG（Streamlit側のPNG再エンコードを避ける）
+    thumb = image.convert("RGB") if image.mode != "RGB" else image.copy()
+    thumb.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
+    buf = io.BytesIO()
+    thumb.save(buf, "JPEG", quality=PREVIEW_JPEG_QUALITY)
+    return buf.getvalue()
+
+
 def analyze_posture(image: Image.Image):
     """
     正面立位想定。
@@ -218,132 +383,197 @@ def analyze_posture(image: Image.Image):
     - ニーイン傾向：両膝間距離 / 両足首間距離 < 0.9 なら注意
     """
     findings = []
-    if not POSE_AVAILABLE:
+    mp = _try_import_pose() if POSE_AVAILABLE else None
+    if mp is None:
         return {"ok": False, "message": "MediaPipeが利用できないため、姿勢解析をスキップしました。", "findings": findings}
 
     mp_pose = mp.solutions.pose
-    img = image.convert("RGB")
-    arr = np.array(img)
-
-    with mp_pose.Pose(static_image_mode=True) as pose:
+    # RGB変換・縮小は必要な時だけ行う（呼び出し元の画像は変更しない）
+    img = image if image.mode == "RGB" else image.convert("RGB")
+    # ランドマーク座標は正規化値なので、縦横比を保てば角度・比率は変わらない
+    if max(img.size) > POSE_MAX_SIDE:
+        img = ImageOps.contain(img, (POSE_MAX_SIDE, POSE_MAX_SIDE), Image.Resampling.BILINEAR)
+    arr = np.ascontiguousarray(np.asarray(img, dtype=np.uint8))
+
+    pose = get_pose()
+    with _pose_lock():
         res = pose.process(arr)
-        if not res.pose_landmarks:
-            return {"ok": False, "message": "ランドマークを検出できませんでした。正面から全身〜上半身が写る明るい写真でお試しください。", "findings": findings}
-
-        lm = res.pose_landmarks.landmark
-
-        def get_xy(idx):
-            return lm[idx].x, lm[idx].y
-
-        def line_angle_deg(p1, p2):
-            dx = p2[0] - p1[0]
-            dy = p2[1] - p1[1]
-            return math.degrees(math.atan2(dy, dx))  # 水平=0°
-
-        def dist(p1, p2):
-            return math.hypot(p2[0]-p1[0], p2[1]-p1[1])
-
-        # 肩
-        ls = get_xy(mp_pose.PoseLandmark.LEFT_SHOULDER.value)
-        rs = get_xy(mp_pose.PoseLandmark.RIGHT_SHOULDER.value)
-        shoulder_deg = line_angle_deg(rs, ls)  # 右→左
-        # 骨盤
-        lh = get_xy(mp_pose.PoseLandmark.LEFT_HIP.value)
-        rh = get_xy(mp_pose.PoseLandmark.RIGHT_HIP.value)
-        hip_deg = line_angle_deg(rh, lh)
-        # 頭（耳ライン）
-        le = get_xy(mp_pose.PoseLandmark.LEFT_EAR.value)
-        re = get_xy(mp_pose.PoseLandmark.RIGHT_EAR.value)
-        head_deg = line_angle_deg(re, le)
-        # 膝と足首距離
-        lk = get_xy(mp_pose.PoseLandmark.LEFT_KNEE.value)
-        rk = get_xy(mp_pose.PoseLandmark.RIGHT_KNEE.value)
-        la = get_xy(mp_pose.PoseLandmark.LEFT_ANKLE.value)
-        ra = get_xy(mp_pose.PoseLandmark.RIGHT_ANKLE.value)
-        knee_w = dist(lk, rk)
-        ankle_w = dist(la, ra)
-
-        if abs(shoulder_deg) >= 5:
-            findings.append(f"肩の高さの左右差：{shoulder_deg:.1f}°（5°以上→要注意）")
-        if abs(hip_deg) >= 5:
-            findings.append(f"骨盤の左右差：{hip_deg:.1f}°（5°以上→要注意）")
-        if abs(head_deg) >= 5:
-            findings.append(f"頭部の傾き：{head_deg:.1f}°（5°以上→要注意）")
-        if ankle_w > 0 and knee_w / ankle_w < 0.9:
-            ratio = knee_w / ankle_w
-            findings.append(f"ニーイン傾向（膝間/足首間比）：{ratio:.2f}（<0.90で注意）")
-
-        advice = []
-        if any("肩" in f for f in findings):
-            advice.append("肩の左右差→僧帽筋上部の過緊張/腹斜筋の弱さの可能性。サイドプランク/ショルダープレスのフォーム修正。")
-        if any("骨盤" in f for f in findings):
-            advice.append("骨盤の左右差→中臀筋/大臀筋の弱さ、股関節の可動域不足。クラムシェル/ヒップヒンジ練習。")
-        if any("頭部" in f for f in findings):
-            advice.append("頭部の傾き→胸鎖乳突筋/僧帽筋の左右差。胸椎伸展と頸部の軽いストレッチを習慣化。")
-        if any("ニーイン" in f for f in findings):
-            advice.append("ニーイン→股関節外旋筋/内転筋バランス。チューブで膝外押し意識のスクワット、グルートブリッジ。")
-
-        return {"ok": True, "message": "解析完了", "findings": findings, "advice": advice}
+    if not res.pose_landmarks:
+        return {"ok": False, "message": "ランドマークを検出できませんでした。正面から全身〜上半身が写る明るい写真でお試しください。", "findings": findings}
+
+    lm = res.pose_landmarks.landmark
+
+    # 左右ペア（左, 右）の順：肩 / 骨盤 / 耳 / 膝 / 足首
+    PL = mp_pose.PoseLandmark
+    indices = [
+        PL.LEFT_SHOULDER.value, PL.RIGHT_SHOULDER.value,
+        PL.LEFT_HIP.value, PL.RIGHT_HIP.value,
+        PL.LEFT_EAR.value, PL.RIGHT_EAR.value,
+        PL.LEFT_KNEE.value, PL.RIGHT_KNEE.value,
+        PL.LEFT_ANKLE.value, PL.RIGHT_ANKLE.value,
+    ]
+    pts = np.array([(lm[i].x, lm[i].y) for i in indices], dtype=np.float32)
+    pairs = pts.reshape(-1, 2, 2)  # (ペア, 左右, xy)
+    d = pairs[:, 0] - pairs[:, 1]  # 右→左
+    # 傾き（肩/骨盤/耳）と幅（膝/足首）をそれぞれ1回の ufunc 呼び出しで算出
+    angles = np.degrees(np.arctan2(d[:3, 1], d[:3, 0]))  # 水平=0°
+    widths = np.hypot(d[3:, 0], d[3:, 1])
+
+    shoulder_deg, hip_deg, head_deg = angles.tolist()
+    # 膝と足首距離
+    knee_w, ankle_w = widths.tolist()
+
+    if abs(shoulder_deg) >= 5:
+        findings.append(f"肩の高さの左右差：{shoulder_deg:.1f}°（5°以上→要注意）")
+    if abs(hip_deg) >= 5:
+        findings.append(f"骨盤の左右差：{hip_deg:.1f}°（5°以上→要注意）")
+    if abs(head_deg) >= 5:
+        findings.append(f"頭部の傾き：{head_deg:.1f}°（5°以上→要注意）")
+    if ankle_w > 0 and knee_w / ankle_w < 0.9:
+        ratio = knee_w / ankle_w
+        findings.append(f"ニーイン傾向（膝間/足首間比）：{ratio:.2f}（<0.90で注意）")
+
+    advice = []
+    if any("肩" in f for f in findings):
+        advice.append("肩の左右差→僧帽筋上部の過緊張/腹斜筋の弱さの可能性。サイドプランク/ショルダープレスのフォーム修正。")
+    if any("骨盤" in f for f in findings):
+        advice.append("骨盤の左右差→中臀筋/大臀筋の弱さ、股関節の可動域不足。クラムシェル/ヒップヒンジ練習。")
+    if any("頭部" in f for f in findings):
+        advice.append("頭部の傾き→胸鎖乳突筋/僧帽筋の左右差。胸椎伸展と頸部の軽いストレッチを習慣化。")
+    if any("ニーイン" in f for f in findings):
+        advice.append("ニーイン→股関節外旋筋/内転筋バランス。チューブで膝外押し意識のスクワット、グルートブリッジ。")
+
+    return {"ok": True, "message": "解析完了", "findings": findings, "advice": advice}
 
 
 # ============== レポート（DOCX） ==============
+@st.cache_resource
+def _report_template():
+    # 既定テンプレの読込（zip展開/スタイル解析）は1度だけ。利用側は deepcopy して使う
+    return Document()
+
+
+# add_paragraph と同じく、タブは <w:tab/>、改行/復帰（\n, \r）は1文字ごとに <w:br/> へ変換する
+_DOCX_RUN_SPECIALS = re.compile(r"([\t\r\n])")
+_DOCX_RUN_SPECIAL_XML = {"\t": "<w:tab/>", "\r": "<w:br/>", "\n": "<w:br/>"}
+
+
+def _docx_run_content(text: str) -> str:
+    out = []
+    for piece in _DOCX_RUN_SPECIALS.split(text):
+        if piece in _DOCX_RUN_SPECIAL_XML:
+            out.append(_DOCX_RUN_SPECIAL_XML[piece])
+        elif piece:
+            # 前後に空白がある場合のみ xml:space="preserve"（python-docx と同じ）
+            space = ' xml:space="preserve"' if piece.strip() != piece else ""
+            out.append(f'<w:t{space}>{escape(piece)}</w:t>')
+    return "".join(out)
+
+
+def _docx_p(text: str, style: str = "", bold: bool = False) -> str:
+    # 1段落分の <w:p> を組み立てる
+    ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    rpr = "<w:rPr><w:b/></w:rPr>" if bold else ""
+    run = f"<w:r>{rpr}{_docx_run_content(str(text))}</w:r>" if text else ""
+    return f"<w:p>{ppr}{run}</w:p>"
+
+
+def _docx_h(text: str, level: int) -> str:
+    return _docx_p(text, style=f"Heading{level}")
+
+
 def build_report_docx(lead: Dict[str, Any], assess: Dict[str, Any], meals, posture) -> bytes:
-    doc = Document()
-    doc.add_heading('AIフィットネス診断レポート', level=1)
-
-    p = doc.add_paragraph()
-    p.add_run(f"お名前：{lead['name']}").bold = True
-    doc.add_paragraph(f"作成日時：{datetime.now().strftime('%Y-%m-%d %H:%M')}")
-
-    doc.add_heading('基本情報', level=2)
-    doc.add_paragraph(f"年齢：{lead['age']} / 性別：{lead['gender']}")
-    doc.add_paragraph(f"身長：{lead['height_cm']} cm / 体重：{lead['weight_kg']} kg")
-    doc.add_paragraph(f"活動レベル：{lead['activity_level']} / 目標：{lead['goal']}")
-    doc.add_paragraph(f"好み：{lead['dietary_prefs']} / アレルギー：{lead['allergies']}")
-
-    doc.add_heading('分析結果（栄養）', level=2)
-    doc.add_paragraph(f"BMI：{assess['bmi']}")
-    doc.add_paragraph(f"BMR（基礎代謝）：{round(assess['bmr'])} kcal")
-    doc.add_paragraph(f"TDEE（推定消費）：{round(assess['tdee'])} kcal")
-    doc.add_paragraph(f"目標カロリー：{assess['target_calories']} kcal")
-    doc.add_paragraph(f"PFC目標：P{assess['protein_g']}g / F{assess['fat_g']}g / C{assess['carbs_g']}g")
-
-    doc.add_heading('1日の食事例', level=2)
-    doc.add_paragraph(meals["guide"])
-    doc.add_paragraph(f"朝：{', '.join(meals['breakfast'])}")
-    doc.add_paragraph(f"昼：{', '.join(meals['lunch'])}")
-    doc.add_paragraph(f"夜：{', '.join(meals['dinner'])}")
-    doc.add_paragraph(f"間食：{', '.join(meals['snack'])}")
-
-    doc.add_heading('姿勢チェック', level=2)
+    doc = copy.deepcopy(_report_template())
+    # 段落はXML文字列として組み立て、最後に1回だけパースして本文へ追加する
+    parts = [
+        _docx_h('AIフィットネス診断レポート', 1),
+        _docx_p(f"お名前：{lead['name']}", bold=True),
+        _docx_p(f"作成日時：{datetime.now().strftime('%Y-%m-%d %H:%M')}"),
+
+        _docx_h('基本情報', 2),
+        _docx_p(f"年齢：{lead['age']} / 性別：{lead['gender']}"),
+        _docx_p(f"身長：{lead['height_cm']} cm / 体重：{lead['weight_kg']} kg"),
+        _docx_p(f"活動レベル：{lead['activity_level']} / 目標：{lead['goal']}"),
+        _docx_p(f"好み：{lead['dietary_prefs']} / アレルギー：{lead['allergies']}"),
+
+        _docx_h('分析結果（栄養）', 2),
+        _docx_p(f"BMI：{assess['bmi']}"),
+        _docx_p(f"BMR（基礎代謝）：{round(assess['bmr'])} kcal"),
+        _docx_p(f"TDEE（推定消費）：{round(assess['tdee'])} kcal"),
+        _docx_p(f"目標カロリー：{assess['target_calories']} kcal"),
+        _docx_p(f"PFC目標：P{assess['protein_g']}g / F{assess['fat_g']}g / C{assess['carbs_g']}g"),
+
+        _docx_h('1日の食事例', 2),
+        _docx_p(meals["guide"]),
+        _docx_p(f"朝：{', '.join(meals['breakfast'])}"),
+        _docx_p(f"昼：{', '.join(meals['lunch'])}"),
+        _docx_p(f"夜：{', '.join(meals['dinner'])}"),
+        _docx_p(f"間食：{', '.join(meals['snack'])}"),
+
+        _docx_h('姿勢チェック', 2),
+    ]
     if posture.get("ok"):
         if posture.get("findings"):
-            doc.add_paragraph("注意ポイント：")
-            for f in posture["findings"]:
-                doc.add_paragraph(f"・{f}")
+            parts.append(_docx_p("注意ポイント："))
+            parts.extend(_docx_p(f"・{f}") for f in posture["findings"])
         else:
-            doc.add_paragraph("大きな偏りは検出されませんでした。")
+            parts.append(_docx_p("大きな偏りは検出されませんでした。"))
         if posture.get("advice"):
-            doc.add_paragraph("改善アドバイス：")
-            for a in posture["advice"]:
-                doc.add_paragraph(f"・{a}")
+            parts.append(_docx_p("改善アドバイス："))
+            parts.extend(_docx_p(f"・{a}") for a in posture["advice"])
     else:
-        doc.add_paragraph(posture.get("message", "解析を実行していません。"))
+        parts.append(_docx_p(posture.get("message", "解析を実行していません。")))
 
-    doc.add_heading('トレーニングの目安', level=2)
-    doc.add_paragraph("週3〜4回、全身（スクワット/ヒンジ/プレス/ロー/体幹）を基本。フォームを動画で毎回チェック。")
+    parts.append(_docx_h('トレーニングの目安', 2))
+    parts.append(_docx_p("週3〜4回、全身（スクワット/ヒンジ/プレス/ロー/体幹）を基本。フォームを動画で毎回チェック。"))
+
+    fragment = parse_xml(f"<w:body {nsdecls('w')}>{''.join(parts)}</w:body>")
+    body = doc.element.body
+    sect_pr = body.find(qn("w:sectPr"))  # 段落はセクション設定より前に置く
+    for p in list(fragment):
+        if sect_pr is not None:
+            sect_pr.addprevious(p)
+        else:
+            body.append(p)
 
     bio = io.BytesIO()
     doc.save(bio)
     return bio.getvalue()
 
 
+# ============== エクスポート（CSV/Excel） ==============
+def export_csv_bytes(df: pd.DataFrame) -> bytes:
+    # Excelで文字化けしないよう BOM 付き UTF-8
+    if pl is not None:
+        try:
+            buf = io.BytesIO()
+            pl.from_pandas(df).write_csv(buf, include_bom=True)
+            return buf.getvalue()
+        except Exception:
+            pass
+    return df.to_csv(index=False).encode("utf-8-sig")
+
+
+def export_excel_bytes(sheets: Dict[str, pd.DataFrame]) -> bytes:
+    # XlsxWriter（高速）を優先し、無ければ openpyxl
+    try:
+        import xlsxwriter  # noqa: F401
+        engine = "xlsxwriter"
+    except ImportError:
+        import openpyxl  # noqa: F401
+        engine = "openpyxl"
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine=engine) as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return buf.getvalue()
+
+
 # ============== LINE ステップ配信テンプレ ==============
-def build_line_step_template(lead_name_placeholder="（お名前）") -> str:
-    return f"""【LINEステップ配信テンプレ（見込み客→予約）】
+LINE_STEP_TEMPLATE = Template("""【LINEステップ配信テンプレ（見込み客→予約）】
 
 Step0（登録直後）：
-{lead_name_placeholder}さん、登録ありがとうございます！
+${name}さん、登録ありがとうございます！
 目的達成まで「短時間×最短距離」で並走します。明日、無料AI診断の結果ダイジェストを送りますね。
 
 Step1（翌日朝9時）：
@@ -372,10 +602,30 @@ Step4（翌日朝9時）：
 ・今の課題3つを可視化
 ご希望の日時を第3候補まで返信ください。記入例：
 「第1：10/20 20:00 第2：10/21 21:30 第3：10/22 19:00」
-"""
+""")
+
+
+def build_line_step_template(lead_name_placeholder="（お名前）") -> str:
+    return LINE_STEP_TEMPLATE.substitute(name=lead_name_placeholder)
+
+
+@st.cache_data(max_entries=32)
+def build_line_step_bytes(lead_name_placeholder="（お名前）") -> bytes:
+    # ダウンロード用に BOM 付き UTF-8 へエンコード済みのバイト列をキャッシュ
+    return build_line_step_template(lead_name_placeholder).encode("utf-8-sig")
 
 
 # ============== Streamlit 画面 ==============
+def show_paged_table(table: pa.Table, key: str):
+    # 全件をブラウザへ送らず、Arrow テーブルの1ページ分だけを渡す
+    pages = max(1, (table.num_rows + PAGE_SIZE - 1) // PAGE_SIZE)
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"ページ（1〜{pages}）", min_value=1, max_value=pages, value=1, step=1, key=f"{key}_page")
+    st.dataframe(table.slice((page - 1) * PAGE_SIZE, PAGE_SIZE), use_container_width=True)
+    st.caption(f"全{table.num_rows}件")
+
+
 def main():
     st.set_page_config(page_title=APP_TITLE, page_icon="💪", layout="wide")
     st.title(APP_TITLE)
@@ -396,29 +646,22 @@ def main():
 
             c4, c5, c6, c7 = st.columns(4)
             age = c4.number_input("年齢", 10, 100, 35)
-            gender = c5.selectbox("性別", ["男性", "女性"])
+            gender = c5.selectbox("性別", GENDERS)
             height_cm = c6.number_input("身長（cm）", 120, 220, 170)
             weight_kg = c7.number_input("体重（kg）", 30.0, 200.0, 65.0, step=0.1)
 
-            activity_level = st.selectbox("活動レベル", [
-                "低い（デスクワーク中心/運動ほぼ無し）",
-                "やや低い（週1〜2軽い運動）",
-                "普通（週3〜4運動）",
-                "高い（週5以上ハード）",
-                "非常に高い（アスリート級）",
-            ])
-            goal = st.selectbox("目標", ["減量（-15〜20%）", "緩やか減量（-10%）", "現状維持", "増量（+10%）"])
+            activity_level = st.selectbox("活動レベル", ACTIVITY_LEVELS)
+            goal = st.selectbox("目標", GOALS)
             dietary_prefs = st.text_input("食の好み（例：和食/高たんぱく/低脂質など）", "")
             allergies = st.text_input("アレルギー（カンマ区切り。例：乳, 卵, 小麦）", "")
 
             submitted = st.form_submit_button("診断を実行")
             if submitted:
                 try:
-                    bmi = calc_bmi(weight_kg, height_cm)
-                    bmr = mifflin_st_jeor_bmr(gender, weight_kg, height_cm, age)
-                    tdee_val = bmr * activity_factor(activity_level)
-                    target_cal = target_calories_from_goal(tdee_val, goal)
-                    p, f, c = macro_plan(weight_kg, target_cal, goal)
+                    bmi, bmr, tdee_val, target_cal, p, f, c = compute_all(
+                        GENDERS.index(gender), weight_kg, height_cm, age,
+                        ACTIVITY_LEVELS.index(activity_level), GOALS.index(goal),
+                    )
                     notes = "高たんぱく/野菜多め/水分を十分に。週3〜4の全身トレと十分な睡眠を推奨。"
 
                     st.session_state["lead"] = {
@@ -459,7 +702,11 @@ def main():
             if img_file is not None:
                 try:
                     image = Image.open(img_file)
-                    st.image(image, caption="アップロード画像プレビュー", use_column_width=True)
+                    # プレビューはアップロードごとに1度だけ生成し、再実行時はバイト列を使い回す
+                    if st.session_state.get("preview_file_id") != img_file.file_id:
+                        st.session_state["preview"] = make_preview_jpeg(image)
+                        st.session_state["preview_file_id"] = img_file.file_id
+                    st.image(st.session_state["preview"], caption="アップロード画像プレビュー")
                     if st.button("姿勢を解析する"):
                         result = analyze_posture(image)
                         st.session_state["posture"] = result
@@ -539,7 +786,7 @@ def main():
                     try:
                         lead_id = insert_lead_and_assessment(lead, {
                             **assess,
-                            "posture_findings": json.dumps(posture, ensure_ascii=False)
+                            "posture_findings": dumps_json(posture)
                         })
                         st.success(f"保存しました（Lead ID: {lead_id}）")
                     except Exception as e:
@@ -547,10 +794,16 @@ def main():
 
             with c2:
                 try:
-                    docx_bytes = build_report_docx(lead, assess, meals, posture)
+                    # 入力が変わらない再実行ではDOCXを作り直さない（meals は lead/assess から決まる）
+                    docx_key = hashlib.blake2b(
+                        json.dumps([lead, assess, posture], default=str, sort_keys=True).encode("utf-8")
+                    ).digest()
+                    if st.session_state.get("docx_key") != docx_key:
+                        st.session_state["docx_bytes"] = build_report_docx(lead, assess, meals, posture)
+                        st.session_state["docx_key"] = docx_key
                     st.download_button(
                         "顧客用レポート（DOCX）をダウンロード",
-                        data=docx_bytes,
+                        data=st.session_state["docx_bytes"],
                         file_name=f"report_{lead['name']}_{datetime.now().strftime('%Y%m%d')}.docx",
                         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                     )
@@ -563,28 +816,24 @@ def main():
     # ==== 4) 保存データ/書き出し ====
     with tabs[3]:
         st.subheader("保存データの一覧とエクスポート")
-        leads_df, assess_df = load_all_data()
+        leads_df, assess_df, leads_table, assess_table = load_all_data()
         st.write("**Leads**")
-        st.dataframe(leads_df, use_container_width=True)
+        show_paged_table(leads_table, "leads")
         st.write("**Assessments**")
-        st.dataframe(assess_df, use_container_width=True)
+        show_paged_table(assess_table, "assessments")
 
         # Export CSV
         c1, c2 = st.columns(2)
         with c1:
-            csv_bytes = leads_df.to_csv(index=False).encode("utf-8-sig")
+            csv_bytes = export_csv_bytes(leads_df)
             st.download_button("LeadsをCSVでダウンロード", data=csv_bytes, file_name="leads.csv", mime="text/csv")
         with c2:
             try:
-                import openpyxl  # for export
-                excel_buf = io.BytesIO()
-                with pd.ExcelWriter(excel_buf, engine="openpyxl") as writer:
-                    leads_df.to_excel(writer, index=False, sheet_name="Leads")
-                    assess_df.to_excel(writer, index=False, sheet_name="Assessments")
-                st.download_button("Leads/AssessmentsをExcel(.xlsx)でダウンロード", data=excel_buf.getvalue(),
+                excel_bytes = export_excel_bytes({"Leads": leads_df, "Assessments": assess_df})
+                st.download_button("Leads/AssessmentsをExcel(.xlsx)でダウンロード", data=excel_bytes,
                                    file_name="export.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
             except Exception as e:
-                st.warning(f"Excel書き出しでエラー：{e}（requirements.txt の openpyxl を確認）")
+                st.warning(f"Excel書き出しでエラー：{e}（requirements.txt の XlsxWriter / openpyxl を確認）")
 
         st.caption("注意：Streamlit Cloudの無料枠では、再デプロイやスリープでローカルDBが初期化されることがあります。永続保存が必要なら外部DB（例：Supabase, Neon等）をご検討ください。")
 
@@ -594,7 +843,7 @@ def main():
         name_placeholder = st.text_input("差し込み用：お名前（任意）", "（お名前）")
         template = build_line_step_template(name_placeholder)
         st.text_area("プレビュー", template, height=300)
-        st.download_button("テンプレTXTをダウンロード", data=template.encode("utf-8-sig"),
+        st.download_button("テンプレTXTをダウンロード", data=build_line_step_bytes(name_placeholder),
                            file_name="line_step_template.txt", mime="text/plain")
 
 